@@ -1,14 +1,54 @@
-import json
+import contextlib
+import fcntl
+import functools
+import hmac
 import os
-import re
+import string
 import tempfile
+import zlib
 from pathlib import Path
 
-from flask import Flask, redirect, render_template, request, url_for
+import orjson
+from flask import Flask, make_response, redirect, render_template, request, url_for
 from flask_httpauth import HTTPBasicAuth
 
-SLUG_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+SLUG_CHARS = (string.ascii_letters + string.digits + "_-").encode("ascii")
+MAX_SLUG_LENGTH = 64
 MAX_MARKDOWN_SIZE = 100_000
+MAX_REQUEST_SIZE = 12 * MAX_MARKDOWN_SIZE + 10_000
+
+INVALID_SLUG_HTML = """
+<script>
+    alert('Invalid note name');
+    window.history.back();
+</script>
+"""
+NOTE_EXISTS_HTML = """
+<script>
+    alert('Note already exists');
+    window.history.back();
+</script>
+"""
+
+
+def _read_note(path):
+    """Read and parse a note file."""
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+_parsed_notes = {}
+
+
+def _parse_note(path, st):
+    """Parse and checksum a note, reusing both while its stat is unchanged."""
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    entry = _parsed_notes.get(path)
+    if entry is None or entry[0] != stat_key:
+        note = _read_note(path)
+        entry = (stat_key, note, zlib.crc32(note["markdown"].encode("utf-8")))
+        _parsed_notes[path] = entry
+    return entry[1], entry[2]
 
 
 def create_app(config=None):
@@ -18,37 +58,71 @@ def create_app(config=None):
     app.config.from_mapping(
         NOTES_DIR=Path("notes"),
         ADMIN_KEY=os.environ.get("NOTES_ADMIN_KEY", "change-me-in-production"),
+        MAX_CONTENT_LENGTH=MAX_REQUEST_SIZE,
+        NOTES_FSYNC=True,
     )
     if config is not None:
         app.config.from_mapping(config)
 
     notes_dir = app.config["NOTES_DIR"]
     notes_dir.mkdir(exist_ok=True)
+    notes_prefix = os.path.join(notes_dir, "")
+
+    init_template = (Path(__file__).parent / "templates" / "init_note.md").read_text()
+    for template_name in ("index.html", "note.html", "conflict.html"):
+        app.jinja_env.get_template(template_name)
+    note_template_source, _, _ = app.jinja_env.loader.get_source(
+        app.jinja_env, "note.html"
+    )
+    template_fingerprint = zlib.crc32(note_template_source.encode("utf-8"))
 
     auth = HTTPBasicAuth()
+    admin_key = app.config["ADMIN_KEY"].encode("utf-8")
 
     @auth.verify_password
     def verify_password(username, password):
         """Verify password for HTTP Basic Auth. Username is ignored."""
-        if password == app.config["ADMIN_KEY"]:
+        if hmac.compare_digest(password.encode("utf-8"), admin_key):
             return "admin"
         return None
 
     def validate_slug(slug):
-        """Validate slug against allowed pattern."""
-        return SLUG_PATTERN.match(slug) is not None
+        """Validate slug against allowed characters and length."""
+        if not slug or len(slug) > MAX_SLUG_LENGTH or not slug.isascii():
+            return False
+        return not slug.encode("ascii").translate(None, SLUG_CHARS)
 
     def get_note_path(slug):
         """Get the file path for a note."""
-        return app.config["NOTES_DIR"] / f"{slug}.json"
+        return f"{notes_prefix}{slug}.json"
 
-    def load_note(slug):
-        """Load a note from disk. Returns None if not found."""
+    lock_path = f"{notes_prefix}.lock"
+
+    @contextlib.contextmanager
+    def lock_notes():
+        """Serialize note writes across threads and worker processes."""
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def load_cached_note(slug):
+        """Load a note and its markdown checksum. Returns None if not found."""
         note_path = get_note_path(slug)
-        if not note_path.exists():
+        try:
+            st = os.stat(note_path)
+        except FileNotFoundError:
             return None
-        with open(note_path, "r") as f:
-            return json.load(f)
+        return _parse_note(note_path, st)
+
+    def load_note(slug, cached=True):
+        """Load a note from disk. Returns None if not found."""
+        if not cached:
+            try:
+                return _read_note(get_note_path(slug))
+            except FileNotFoundError:
+                return None
+        cached_note = load_cached_note(slug)
+        return None if cached_note is None else cached_note[0]
 
     def save_note(slug, markdown, version):
         """Save a note to disk."""
@@ -58,9 +132,12 @@ def create_app(config=None):
             "version": version,
         }
         with tempfile.NamedTemporaryFile(
-            mode="w", dir=note_path.parent, delete=False, suffix=".tmp"
+            mode="wb", dir=notes_dir, prefix=f".{slug}.", suffix=".tmp", delete=False
         ) as f:
-            json.dump(note_data, f, indent=2)
+            f.write(orjson.dumps(note_data, option=orjson.OPT_INDENT_2))
+            if app.config["NOTES_FSYNC"]:
+                f.flush()
+                os.fsync(f.fileno())
             tmp_path = f.name
         os.replace(tmp_path, note_path)
 
@@ -71,68 +148,84 @@ def create_app(config=None):
         slug = request.form.get("slug", "").strip()
 
         if not validate_slug(slug):
-            return """
-            <script>
-                alert('Invalid note name');
-                window.history.back();
-            </script>
-            """, 400
-
-        if load_note(slug):
-            return """
-            <script>
-                alert('Note already exists');
-                window.history.back();
-            </script>
-            """, 409
-
-        init_template_path = Path(__file__).parent / "templates" / "init_note.md"
-        with open(init_template_path, "r") as f:
-            template_content = f.read()
-        default_markdown = f"# {slug}\n{template_content}"
-        save_note(slug, default_markdown, 1)
+            return INVALID_SLUG_HTML, 400
+
+        default_markdown = f"# {slug}\n{init_template}"
+
+        with lock_notes():
+            if load_note(slug, cached=False):
+                return NOTE_EXISTS_HTML, 409
+            save_note(slug, default_markdown, 1)
 
         return redirect(url_for("view_note", slug=slug), code=303)
 
+    rendered_notes = {}
+
+    def render_note(slug, note, checksum):
+        """Render a note page, reusing the last render while the note is unchanged."""
+        render_key = (note["version"], checksum)
+        entry = rendered_notes.get(slug)
+        if entry is None or entry[0] != render_key:
+            html = render_template("note.html", slug=slug, note=note).encode("utf-8")
+            entry = (render_key, html)
+            rendered_notes[slug] = entry
+        return entry[1]
+
     @app.route("/notes/<slug>", methods=["GET"])
     def view_note(slug):
         """View a note."""
         if not validate_slug(slug):
             return "Invalid note slug", 400
-        note = load_note(slug)
-        if note is None:
+        cached_note = load_cached_note(slug)
+        if cached_note is None:
             return "Note not found", 404
-        return render_template("note.html", slug=slug, note=note)
+        note, checksum = cached_note
+        etag = f"{slug}-{note['version']}-{checksum:08x}-{template_fingerprint:08x}"
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(render_note(slug, note, checksum))
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
 
     @app.route("/notes/<slug>", methods=["POST"])
     def update_note(slug):
         """Update an existing note."""
         if not validate_slug(slug):
             return "Invalid note slug", 400
-        note = load_note(slug)
-        if note is None:
+        if load_note(slug) is None:
             return "Note not found", 404
         new_markdown = request.form.get("markdown", "")
         client_version = int(request.form.get("version", 0))
         if len(new_markdown) > MAX_MARKDOWN_SIZE:
             return "Note content too large", 413
-        current_version = note["version"]
-        if client_version != current_version:
-            return render_template(
-                "conflict.html",
-                slug=slug,
-                my_markdown=new_markdown,
-                their_markdown=note["markdown"],
-                current_version=current_version,
-            ), 409
-        new_version = current_version + 1
-        save_note(slug, new_markdown, new_version)
+        with lock_notes():
+            note = load_note(slug, cached=False)
+            if note is None:
+                return "Note not found", 404
+            current_version = note["version"]
+            if client_version != current_version:
+                return render_template(
+                    "conflict.html",
+                    slug=slug,
+                    my_markdown=new_markdown,
+                    their_markdown=note["markdown"],
+                    current_version=current_version,
+                ), 409
+            save_note(slug, new_markdown, current_version + 1)
         return redirect(url_for("view_note", slug=slug), code=303)
 
+    @functools.cache
+    def render_index():
+        """Render the static landing page once per app."""
+        return render_template("index.html").encode("utf-8")
+
     @app.route("/")
     def index():
         """Landing page with create form."""
-        return render_template("index.html")
+        return render_index(), {"Cache-Control": "public, max-age=3600"}
 
     return app
 
@@ -1,6 +1,4 @@
-import shutil
 import sys
-import tempfile
 from base64 import b64encode
 from pathlib import Path
 
@@ -9,23 +7,21 @@ import pytest
 # Add project root to Python path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+import app as app_module
 from app import create_app
 
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     """Create test app with isolated temp directory."""
-    test_notes_dir = tempfile.mkdtemp()
-
-    test_app = create_app(
+    return create_app(
         config={
             "TESTING": True,
-            "NOTES_DIR": Path(test_notes_dir),
+            "NOTES_DIR": tmp_path,
             "ADMIN_KEY": "test-admin-key",
+            "NOTES_FSYNC": False,
         }
     )
-    yield test_app
-    shutil.rmtree(test_notes_dir, ignore_errors=True)
 
 
 @pytest.fixture
@@ -35,6 +31,20 @@ def auth_headers():
     return {"Authorization": f"Basic {credentials}"}
 
 
+@pytest.fixture
+def rendered_templates(monkeypatch):
+    """Record the name of every template rendered by the app."""
+    rendered = []
+    render_template = app_module.render_template
+
+    def _render_template(name, **context):
+        rendered.append(name)
+        return render_template(name, **context)
+
+    monkeypatch.setattr(app_module, "render_template", _render_template)
+    return rendered
+
+
 @pytest.fixture
 def create_note(app):
     """Helper to create test notes. Duplicates app logic for test isolation."""
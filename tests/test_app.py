@@ -1,59 +1,197 @@
 import json
+import os
+import zlib
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from jinja2 import FileSystemLoader
+
+import app as app_module
+from app import create_app
+
+INVALID_SLUGS = [
+    "test/path",  # invalid route
+    "../etc",  # invalid route
+    "/notes/.../etc/passwd",  # invalid route
+    "test space",  # invalid char
+    "test@note",  # invalid char
+    "test.note",  # invalid char
+    "tést",  # non-ascii char
+    "",  # empty
+    "a" * 65,  # overly long
+]
+VALID_SLUGS = ["test", "test-123", "my_note", "ABC-def_123", "a" * 64]
 
 
 class TestNoteViewing:
     """Test note viewing functionality."""
 
-    def test_view_nonexistent_note_returns_404(self, app):
+    def test_view_nonexistent_note_returns_404(self, client):
         """Viewing non-existent note returns 404"""
-        response = app.test_client().get("/notes/doesnotexist")
+        response = client.get("/notes/doesnotexist")
         assert response.status_code == 404
         assert b"not found" in response.data.lower()
 
-    def test_view_existing_note(self, app, create_note):
+    def test_view_existing_note(self, client, create_note):
         """Viewing an existing note works"""
         create_note("mytest")
-        response = app.test_client().get("/notes/mytest")
+        response = client.get("/notes/mytest")
         assert response.status_code == 200
         assert b"mytest" in response.data
         assert b"First item" in response.data
 
-    def test_invalid_slugs(self, app):
+    def test_view_reflects_rewritten_note(self, client, create_note):
+        """Viewing a note after its file changes shows the new content"""
+        create_note("rewrite-test", markdown="# Old content\n")
+        client.get("/notes/rewrite-test")
+        create_note("rewrite-test", markdown="# Newer content\n", version=2)
+        response = client.get("/notes/rewrite-test")
+        assert b"Newer content" in response.data
+        assert b"Old content" not in response.data
+
+    def test_parse_cache_keeps_only_latest_version(self, client, create_note):
+        """Editing a note replaces its parse cache entry instead of adding one"""
+        note_path = str(create_note("parse-cache-test"))
+        for version in range(1, 4):
+            client.post(
+                "/notes/parse-cache-test",
+                data={"markdown": f"# Version {version + 1}\n", "version": version},
+            )
+            client.get("/notes/parse-cache-test")
+        notes_dir = os.path.dirname(note_path)
+        cached_paths = [
+            path
+            for path in app_module._parsed_notes
+            if os.path.dirname(path) == notes_dir
+        ]
+        assert cached_paths == [note_path]
+        _, note, checksum = app_module._parsed_notes[note_path]
+        assert note == {"markdown": "# Version 4\n", "version": 4}
+        assert checksum == zlib.crc32(b"# Version 4\n")
+
+    def test_view_unchanged_note_returns_304(self, client, create_note):
+        """Revalidating an unchanged note returns 304 without a body"""
+        create_note("etag-test")
+        response = client.get("/notes/etag-test")
+        etag = response.headers["ETag"]
+        assert "no-cache" in response.headers["Cache-Control"]
+        response = client.get("/notes/etag-test", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+
+    def test_view_edited_note_returns_200(self, client, create_note):
+        """Revalidating a note after an edit returns the new content"""
+        create_note("etag-test")
+        etag = client.get("/notes/etag-test").headers["ETag"]
+        client.post(
+            "/notes/etag-test",
+            data={"markdown": "# Edited\n", "version": "1"},
+        )
+        response = client.get("/notes/etag-test", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert b"Edited" in response.data
+
+    def test_view_hand_edited_note_returns_200(self, client, create_note):
+        """Revalidating a note edited without a version bump returns new content"""
+        create_note("hand-edit-test", markdown="# Before\n")
+        etag = client.get("/notes/hand-edit-test").headers["ETag"]
+        create_note("hand-edit-test", markdown="# After the edit\n")
+        response = client.get("/notes/hand-edit-test", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert b"After the edit" in response.data
+
+    def test_view_after_template_change_returns_200(
+        self, app, client, create_note, monkeypatch
+    ):
+        """Revalidating after the note template changes returns a fresh page"""
+        create_note("deploy-test")
+        etag = client.get("/notes/deploy-test").headers["ETag"]
+        get_source = FileSystemLoader.get_source
+
+        def changed_get_source(self, environment, template):
+            source, filename, uptodate = get_source(self, environment, template)
+            return source + "<!-- changed -->", filename, uptodate
+
+        monkeypatch.setattr(FileSystemLoader, "get_source", changed_get_source)
+        deployed_client = create_app(config=app.config).test_client()
+        response = deployed_client.get(
+            "/notes/deploy-test", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert b"<!-- changed -->" in response.data
+
+    def test_view_unchanged_note_renders_once(
+        self, client, create_note, rendered_templates
+    ):
+        """Repeat views of an unchanged note reuse the rendered page"""
+        create_note("render-cache-test")
+        first = client.get("/notes/render-cache-test")
+        second = client.get("/notes/render-cache-test")
+        assert first.data == second.data
+        assert rendered_templates == ["note.html"]
+
+    def test_view_hand_edited_note_rerenders(
+        self, client, create_note, rendered_templates
+    ):
+        """Changing the markdown without a version bump renders the page again"""
+        create_note("render-cache-test", markdown="# Before\n")
+        client.get("/notes/render-cache-test")
+        create_note("render-cache-test", markdown="# After the edit\n")
+        response = client.get("/notes/render-cache-test")
+        assert b"After the edit" in response.data
+        assert rendered_templates == ["note.html", "note.html"]
+
+    def test_view_edited_note_renders_once_per_version(
+        self, client, create_note, rendered_templates
+    ):
+        """An edit renders the page once, then later views reuse it"""
+        create_note("render-cache-test")
+        client.get("/notes/render-cache-test")
+        client.post(
+            "/notes/render-cache-test",
+            data={"markdown": "# Edited\n", "version": "1"},
+        )
+        client.get("/notes/render-cache-test")
+        response = client.get("/notes/render-cache-test")
+        assert b"Edited" in response.data
+        assert rendered_templates == ["note.html", "note.html"]
+
+    @pytest.mark.parametrize("slug", INVALID_SLUGS)
+    def test_invalid_slugs(self, client, slug):
         """
         Invalid slugs are rejected through either
         a) Flasks routing or b) slug validation
         """
-        invalid_slugs = [
-            "test/path",  # invalid route
-            "../etc",  # invalid route
-            "/notes/.../etc/passwd",  # invalid route
-            "test space",  # invalid char
-            "test@note",  # invalid char
-            "test.note",  # invalid char
-            "",  # empty
-            "a" * 65,  # overly long
-        ]
-        for slug in invalid_slugs:
-            response = app.test_client().get(f"/notes/{slug}")
-            # Either 400 (our validation) or 404 (Flask routing) blocks the request
-            assert response.status_code in [400, 404], (
-                f"Slug '{slug}' should be blocked (got {response.status_code})"
-            )
+        response = client.get(f"/notes/{slug}")
+        # Either 400 (our validation) or 404 (Flask routing) blocks the request
+        assert response.status_code in [400, 404], (
+            f"Slug '{slug}' should be blocked (got {response.status_code})"
+        )
 
 
 class TestNoteCreation:
     """Test note creation."""
 
-    def test_create_note_requires_auth(self, app):
+    def test_create_note_requires_auth(self, client):
         """Create without auth fails"""
-        response = app.test_client().post("/notes", data={"slug": "test"})
+        response = client.post("/notes", data={"slug": "test"})
+        assert response.status_code == 401
+
+    def test_create_note_with_wrong_key_fails(self, client):
+        """Create with the wrong admin key fails"""
+        credentials = b64encode(b":wrong-key").decode("utf-8")
+        response = client.post(
+            "/notes",
+            data={"slug": "test"},
+            headers={"Authorization": f"Basic {credentials}"},
+        )
         assert response.status_code == 401
 
-    def test_create_note_succeeds(self, app, auth_headers):
+    def test_create_note_succeeds(self, client, auth_headers):
         """Create with auth succeeds"""
-        response = app.test_client().post(
+        response = client.post(
             "/notes",
             data={"slug": "test"},
             headers=auth_headers,
@@ -62,30 +200,25 @@ class TestNoteCreation:
         assert response.status_code == 303
         assert response.location == "/notes/test"
 
-    def test_create_invalid_slug_fails(self, app, auth_headers):
+    @pytest.mark.parametrize("slug", VALID_SLUGS)
+    def test_create_valid_slug_succeeds(self, client, auth_headers, slug):
+        """Valid slugs are accepted when creating notes"""
+        response = client.post("/notes", data={"slug": slug}, headers=auth_headers)
+        assert response.status_code == 303
+        assert response.location == f"/notes/{slug}"
+
+    @pytest.mark.parametrize("slug", INVALID_SLUGS)
+    def test_create_invalid_slug_fails(self, client, auth_headers, slug):
         """Invalid slugs are rejected when creating notes"""
-        invalid_slugs = [
-            "test/path",  # invalid route
-            "../etc",  # invalid route
-            "/notes/.../etc/passwd",  # invalid route
-            "test space",  # invalid char
-            "test@note",  # invalid char
-            "test.note",  # invalid char
-            "",  # empty
-            "a" * 65,  # overly long
-        ]
-        for slug in invalid_slugs:
-            response = app.test_client().post(
-                "/notes", data={"slug": slug}, headers=auth_headers
-            )
-            assert response.status_code == 400, (
-                f"Slug '{slug}' should be rejected with 400 (got {response.status_code})"
-            )
+        response = client.post("/notes", data={"slug": slug}, headers=auth_headers)
+        assert response.status_code == 400, (
+            f"Slug '{slug}' should be rejected with 400 (got {response.status_code})"
+        )
 
-    def test_create_existing_note_fails(self, app, auth_headers, create_note):
+    def test_create_existing_note_fails(self, client, auth_headers, create_note):
         """Creating duplicate returns 409"""
         create_note("existing")
-        response = app.test_client().post(
+        response = client.post(
             "/notes", data={"slug": "existing"}, headers=auth_headers
         )
         assert response.status_code == 409
@@ -94,24 +227,24 @@ class TestNoteCreation:
 class TestNoteEditing:
     """Test note editing."""
 
-    def test_edit_note_with_correct_version(self, app, create_note):
+    def test_edit_note_with_correct_version(self, client, create_note):
         """Editing note without auth and correct version succeeds"""
         create_note("edit-test")
-        response = app.test_client().post(
+        response = client.post(
             "/notes/edit-test",
             data={"markdown": "# Updated\n\n- [x] Done", "version": "1"},
             follow_redirects=False,
         )
         assert response.status_code == 303
         assert response.location == "/notes/edit-test"
-        response = app.test_client().get("/notes/edit-test")
+        response = client.get("/notes/edit-test")
         assert b"Updated" in response.data
         assert b"Done" in response.data
 
-    def test_edit_note_with_wrong_version_returns_409(self, app, create_note):
+    def test_edit_note_with_wrong_version_returns_409(self, client, create_note):
         """Editing note with wrong version returns conflict"""
         create_note("conflict-test")
-        response = app.test_client().post(
+        response = client.post(
             "/notes/conflict-test",
             data={"markdown": "# Should fail", "version": "999"},
         )
@@ -123,10 +256,10 @@ class TestNoteEditing:
 class TestNoteConflict:
     """Test conflict resolution behavior."""
 
-    def test_conflict_page_shows_both_versions(self, app, create_note):
+    def test_conflict_page_shows_both_versions(self, client, create_note):
         """Conflict page renders both the submitted and current content"""
         create_note("conflict-test", markdown="# Their version\n", version=2)
-        response = app.test_client().post(
+        response = client.post(
             "/notes/conflict-test",
             data={"markdown": "# My version\n", "version": "1"},
         )
@@ -135,11 +268,11 @@ class TestNoteConflict:
         assert b"My version" in response.data
         assert b"Their version" in response.data
 
-    def test_conflict_save_merged_content(self, app, create_note):
+    def test_conflict_save_merged_content(self, client, create_note):
         """Saving from conflict page with current version succeeds"""
         create_note("conflict-test", markdown="# Their version\n", version=2)
 
-        response = app.test_client().post(
+        response = client.post(
             "/notes/conflict-test",
             data={"markdown": "# Merged\n", "version": "2"},
             follow_redirects=True,
@@ -148,64 +281,125 @@ class TestNoteConflict:
         assert response.status_code == 200
         assert b"Merged" in response.data
 
-    def test_edit_note_increments_version(self, app, create_note):
+    def test_concurrent_edits_with_same_version(self, app, create_note):
+        """Only one of several concurrent edits of the same version succeeds"""
+        create_note("race-test")
+
+        def edit(i):
+            response = app.test_client().post(
+                "/notes/race-test",
+                data={"markdown": f"# Edit {i}\n", "version": "1"},
+            )
+            return response.status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            status_codes = list(pool.map(edit, range(8)))
+
+        assert status_codes.count(303) == 1
+        assert status_codes.count(409) == 7
+
+    def test_edit_checks_version_of_same_size_rewrite(self, client, create_note):
+        """Version check sees a same-size rewrite that keeps the old mtime"""
+        note_path = create_note("stale-test", markdown="# Old content\n")
+        client.get("/notes/stale-test")
+        st = os.stat(note_path)
+        create_note("stale-test", markdown="# New content\n", version=2)
+        os.utime(note_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert os.stat(note_path).st_size == st.st_size
+
+        response = client.post(
+            "/notes/stale-test",
+            data={"markdown": "# Lost update\n", "version": "1"},
+        )
+        assert response.status_code == 409
+        with open(note_path) as f:
+            assert json.load(f)["markdown"] == "# New content\n"
+
+    def test_edit_note_increments_version(self, client, create_note):
         """Editing note increments version number"""
         create_note("version-test")
-        app.test_client().post(
+        client.post(
             "/notes/version-test",
             data={"markdown": "# Version 2", "version": "1"},
         )
 
         # Try to edit with old version, should fail
-        response = app.test_client().post(
+        response = client.post(
             "/notes/version-test",
             data={"markdown": "# Should fail", "version": "1"},
         )
         assert response.status_code == 409
 
-    def test_edit_nonexistent_note_returns_404(self, app):
+    def test_edit_nonexistent_note_returns_404(self, client):
         """Editing non-existent note returns 404."""
-        response = app.test_client().post(
+        response = client.post(
             "/notes/doesnotexist",
             data={"markdown": "# Test", "version": "1"},
         )
         assert response.status_code == 404
 
-    def test_edit_note_too_large_returns_413(self, app, create_note):
+    def test_edit_note_too_large_returns_413(self, client, create_note):
         """Editing note with content too large returns 413."""
         create_note("large-test")
         large_content = "x" * 200_000
-        response = app.test_client().post(
+        response = client.post(
             "/notes/large-test",
             data={"markdown": large_content, "version": "1"},
         )
 
         assert response.status_code == 413
 
+    @pytest.mark.parametrize(
+        "markdown",
+        ["笔记" * 49_999, "é" * 99_999, "😀" * 99_999],
+        ids=["cjk", "latin", "emoji"],
+    )
+    def test_edit_note_multibyte_under_limit_succeeds(
+        self, client, create_note, markdown
+    ):
+        """Editing note with multibyte markdown under the limit succeeds."""
+        create_note("multibyte-test")
+        response = client.post(
+            "/notes/multibyte-test",
+            data={"markdown": markdown, "version": "1"},
+        )
+
+        assert response.status_code == 303
+
+    def test_edit_note_markdown_over_limit_returns_413(self, client, create_note):
+        """Editing note with markdown just over the limit returns 413."""
+        create_note("limit-test")
+        response = client.post(
+            "/notes/limit-test",
+            data={"markdown": "x" * 100_001, "version": "1"},
+        )
+
+        assert response.status_code == 413
+
 
 class TestNoteRendering:
     """Test note UI/template rendering."""
 
-    def test_note_has_expected_tabs(self, app, create_note):
+    def test_note_has_expected_tabs(self, client, create_note):
         """Note page has expected tabs."""
         create_note("ui-test")
-        response = app.test_client().get("/notes/ui-test")
+        response = client.get("/notes/ui-test")
         assert response.status_code == 200
         assert b"preview" in response.data.lower()
         assert b"edit" in response.data.lower()
 
-    def test_note_contains_markdown_scripts(self, app, create_note):
+    def test_note_contains_markdown_scripts(self, client, create_note):
         """Note page includes markdown-it scripts."""
         create_note("render-test")
-        response = app.test_client().get("/notes/render-test")
+        response = client.get("/notes/render-test")
         assert b"markdown-it" in response.data
         assert b"markdown-it-task-lists" in response.data
         assert b"dompurify" in response.data
 
-    def test_note_json_data_embedded(self, app, create_note):
+    def test_note_json_data_embedded(self, client, create_note):
         """Note data is embedded in page for JS."""
         create_note("json-test")
-        response = app.test_client().get("/notes/json-test")
+        response = client.get("/notes/json-test")
         assert b"First item" in response.data
         assert b'name="version"' in response.data
 
@@ -213,8 +407,21 @@ class TestNoteRendering:
 class TestHomePage:
     """Test home page."""
 
-    def test_home_page_renders(self, app):
+    def test_home_page_renders(self, client):
         """Home page renders successfully."""
-        response = app.test_client().get("/")
+        response = client.get("/")
         assert response.status_code == 200
         assert b"Tiny Markdown Notes" in response.data
+
+    def test_home_page_is_cacheable(self, client):
+        """Home page is served with a public cache header."""
+        response = client.get("/")
+        assert response.mimetype == "text/html"
+        assert "public" in response.headers["Cache-Control"]
+
+    def test_home_page_renders_once(self, client, rendered_templates):
+        """Home page template is rendered only on the first request."""
+        first = client.get("/")
+        second = client.get("/")
+        assert first.data == second.data
+        assert rendered_templates == ["index.html"]